@@ -3,6 +3,7 @@ import json
 import os
 import shutil
 import stat
+from collections import defaultdict
 
 import numpy
 import progressbar
@@ -221,7 +222,7 @@ class Step:
         self.inputs = list()
         self.outputs = list()
         self.namelist_data = dict()
-        self.streams_data = dict()
+        self.streams_data = defaultdict(list)
 
         # these will be set later during setup
         self.config = None
@@ -594,12 +595,8 @@ class Step:
         if out_name is None:
             out_name = f'streams.{self.mpas_core.name}'
 
-        if out_name not in self.streams_data:
-            self.streams_data[out_name] = list()
-
         self.streams_data[out_name].append(
-            dict(package=package, streams=streams,
-                 replacements=template_replacements, mode=mode))
+            (package, streams, template_replacements, mode))
 
     def update_streams_at_runtime(self, package, streams,
                                   template_replacements, out_name=None):
@@ -839,43 +836,38 @@ class Step:
         step_work_dir = self.work_dir
         config = self.config
 
-        for out_name in self.streams_data:
+        for out_name, entries in self.streams_data.items():
 
             # generate the streams file
             tree = None
 
             mode = None
 
-            for entry in self.streams_data[out_name]:
+            for package, streams, replacements, entry_mode in entries:
                 if mode is None:
-                    mode = entry['mode']
+                    mode = entry_mode
                 else:
-                    assert mode == entry['mode']
+                    assert mode == entry_mode
 
                 tree = compass.streams.read(
-                    package=entry['package'],
-                    streams_filename=entry['streams'],
-                    replacements=entry['replacements'], tree=tree)
+                    package=package, streams_filename=streams,
+                    replacements=replacements, tree=tree)
 
             defaults_filename = config.get('streams', mode)
             out_filename = f'{step_work_dir}/{out_name}'
 
-            defaults_tree = etree.parse(defaults_filename)
+            defaults_tree = compass.streams.read_defaults(defaults_filename)
 
-            defaults = next(defaults_tree.iter('streams'))
-            streams = next(tree.iter('streams'))
+            defaults = compass.streams.get_streams_element(defaults_tree)
+            streams = compass.streams.get_streams_element(tree)
 
             for stream in streams:
                 compass.streams.update_defaults(stream, defaults)
 
             # remove any streams that aren't requested
-            for default in defaults:
-                found = False
-                for stream in streams:
-                    if stream.attrib['name'] == default.attrib['name']:
-                        found = True
-                        break
-                if not found:
+            requested = {stream.attrib['name'] for stream in streams}
+            for default in list(defaults):
+                if default.attrib['name'] not in requested:
                     defaults.remove(default)
 
             compass.streams.write(defaults_tree, out_filename)
@@ -1,7 +1,19 @@
-from lxml import etree
-from copy import deepcopy
+import os
+from copy import copy, deepcopy
+from functools import lru_cache
 from importlib import resources
+
 from jinja2 import Template
+from lxml import etree
+
+# whitespace between elements is not needed because we write out the streams
+# ourselves, and streams files do not rely on IDs or entities
+_PARSER = etree.XMLParser(remove_blank_text=True, collect_ids=False,
+                          resolve_entities=False)
+
+# each attribute of a stream goes on its own line, aligned after the tag
+_IMMUTABLE_INDENT = '\n' + ' ' * len('<immutable_stream ')
+_STREAM_INDENT = '\n' + ' ' * len('<stream ')
 
 
 def read(package, streams_filename, tree=None, replacements=None):
@@ -29,74 +41,134 @@ def read(package, streams_filename, tree=None, replacements=None):
         A tree of XML data describing MPAS i/o streams with the content from
         the given streams file
     """
-    if replacements is None:
-        text = resources.read_text(package, streams_filename)
+    template = None
+    if replacements is not None:
+        template = _load_template(package, streams_filename)
+
+    if template is None:
+        text = _read_text(package, streams_filename)
     else:
-        template = Template(resources.read_text(package, streams_filename))
         text = template.render(**replacements)
 
-    new_tree = etree.fromstring(text)
+    new_tree = etree.fromstring(text.encode('utf-8'), _PARSER)
 
     tree = _update_tree(tree, new_tree)
 
     return tree
 
 
-def write(streams, out_filename):
-    """ write the streams XML data to the file """
+def read_defaults(defaults_filename):
+    """
+    Parse the default streams file for an MPAS core
 
-    with open(out_filename, 'w') as stream_file:
+    Parameters
+    ----------
+    defaults_filename : str
+        The name of the default streams file to read from
 
-        stream_file.write('<streams>\n')
+    Returns
+    -------
+    tree : lxml.etree
+        A tree of XML data describing the default MPAS i/o streams, which the
+        caller is free to modify
+    """
+    mtime = os.path.getmtime(defaults_filename)
+    # the cached tree must not be modified, so we return a copy
+    return deepcopy(_parse_defaults(defaults_filename, mtime))
 
-        # Write out all immutable streams first
-        for stream in streams.findall('immutable_stream'):
-            stream_name = stream.attrib['name']
 
-            stream_file.write('\n')
-            stream_file.write('<immutable_stream name="{}"'.format(
-                stream_name))
-            # Process all attributes on the stream
-            for attr, val in stream.attrib.items():
-                if attr.strip() != 'name':
-                    stream_file.write('\n                  {}="{}"'.format(
-                        attr, val))
+def get_streams_element(tree):
+    """
+    Get the ``<streams>`` element from a tree of streams
 
-            stream_file.write('/>\n')
+    Parameters
+    ----------
+    tree : lxml.etree
+        A tree of XML data describing MPAS i/o streams, either an element or
+        an element tree
+
+    Returns
+    -------
+    streams : lxml.etree.Element
+        The ``<streams>`` element, typically the root of the tree
+    """
+    if not etree.iselement(tree):
+        # an element tree, e.g. from etree.parse()
+        tree = tree.getroot()
+    if tree.tag == 'streams':
+        return tree
+    return tree.find('.//streams')
 
-        # Write out all immutable streams
-        for stream in streams.findall('stream'):
-            stream_name = stream.attrib['name']
 
-            stream_file.write('\n')
-            stream_file.write('<stream name="{}"'.format(stream_name))
+def write(streams, out_filename):
+    """ write the streams XML data to the file """
 
-            # Process all attributes
-            for attr, val in stream.attrib.items():
-                if attr.strip() != 'name':
-                    stream_file.write('\n        {}="{}"'.format(attr, val))
+    streams = get_streams_element(streams)
 
-            stream_file.write('>\n\n')
+    # immutable streams come first, followed by the other streams in their
+    # original order (the sort is stable).  Any other elements are skipped.
+    ordered = sorted(
+        (stream for stream in streams
+         if stream.tag in ['immutable_stream', 'stream']),
+        key=lambda stream: stream.tag != 'immutable_stream')
 
-            # Write out all contents of the stream
-            for tag in ['stream', 'var_struct', 'var_array', 'var']:
-                for child in stream.findall(tag):
-                    child_name = child.attrib['name']
-                    if tag == 'stream' and child_name == stream_name:
-                        # don't include the stream itself
-                        continue
-                    if 'packages' in child.attrib.keys():
-                        package_name = child.attrib['packages']
-                        entry = '    <{} name="{}" packages="{}"/>\n' \
-                                ''.format(tag, child_name, package_name)
-                    else:
-                        entry = '    <{} name="{}"/>\n'.format(tag, child_name)
-                    stream_file.write(entry)
+    text = list()
+    text.append('<streams>\n')
 
-            stream_file.write('</stream>\n')
+    for stream in ordered:
+        stream_name = stream.attrib['name']
 
-        stream_file.write('\n')
-        stream_file.write('</streams>\n')
+        text.append('\n')
+
+        if stream.tag == 'immutable_stream':
+            text.append(f'<immutable_stream name="{stream_name}"')
+            # Process all attributes on the stream
+            text.append(''.join(
+                f'{_IMMUTABLE_INDENT}{attr}="{val}"'
+                for attr, val in stream.attrib.items()
+                if attr.strip() != 'name'))
+
+            text.append('/>\n')
+            continue
+
+        text.append(f'<stream name="{stream_name}"')
+
+        # Process all attributes
+        text.append(''.join(
+            f'{_STREAM_INDENT}{attr}="{val}"'
+            for attr, val in stream.attrib.items()
+            if attr.strip() != 'name'))
+
+        text.append('>\n\n')
+
+        # Sort the contents of the stream by tag in a single pass
+        contents = dict(stream=[], var_struct=[], var_array=[], var=[])
+        for child in stream:
+            if child.tag in contents:
+                contents[child.tag].append(child)
+
+        # Write out all contents of the stream
+        for tag, children in contents.items():
+            for child in children:
+                child_name = child.attrib['name']
+                if tag == 'stream' and child_name == stream_name:
+                    # don't include the stream itself
+                    continue
+                if 'packages' in child.attrib.keys():
+                    package_name = child.attrib['packages']
+                    entry = f'    <{tag} name="{child_name}" ' \
+                            f'packages="{package_name}"/>\n'
+                else:
+                    entry = f'    <{tag} name="{child_name}"/>\n'
+                text.append(entry)
+
+        text.append('</stream>\n')
+
+    text.append('\n')
+    text.append('</streams>\n')
+
+    with open(out_filename, 'w') as stream_file:
+        stream_file.write(''.join(text))
 
 
 def update_defaults(new_child, defaults):
@@ -104,35 +176,34 @@ def update_defaults(new_child, defaults):
     Update a stream or its children (sub-stream, var, etc.) starting from the
     defaults or add it if it's new.
     """
-    if 'name' not in new_child.attrib:
-        return
+    _update_defaults(new_child, defaults, _name_index(defaults))
 
-    name = new_child.attrib['name']
-    found = False
-    for child in defaults:
-        if child.attrib['name'] == name:
-            found = True
-            if child.tag != new_child.tag:
-                raise ValueError('Trying to update stream "{}" with '
-                                 'inconsistent tags {} vs. {}.'.format(
-                                     name, child.tag, new_child.tag))
 
-            # copy the attributes
-            for attr, value in new_child.attrib.items():
-                child.attrib[attr] = value
+@lru_cache(maxsize=None)
+def _read_text(package, streams_filename):
+    """ read the contents of a streams file from a package only once """
+    return resources.read_text(package, streams_filename)
 
-            if len(new_child) > 0:
-                # we don't want default grandchildren
-                for grandchild in child:
-                    child.remove(grandchild)
 
-            # copy or add the grandchildren's contents
-            for new_grandchild in new_child:
-                update_defaults(new_grandchild, child)
+@lru_cache(maxsize=None)
+def _load_template(package, streams_filename):
+    """
+    compile a Jinja2 template for a streams file only once, or return
+    ``None`` if the file has no Jinja2 syntax and so needs no rendering
+    """
+    text = _read_text(package, streams_filename)
+    if not any(delimiter in text for delimiter in ['{{', '{%', '{#']):
+        return None
+    return Template(text)
 
-    if not found:
-        # add a deep copy of the element
-        defaults.append(deepcopy(new_child))
+
+@lru_cache(maxsize=8)
+def _parse_defaults(defaults_filename, mtime):
+    """
+    parse a default streams file only once unless it has been modified (as
+    indicated by a new ``mtime``)
+    """
+    return etree.parse(defaults_filename, _PARSER)
 
 
 def _update_tree(tree, new_tree):
@@ -140,40 +211,98 @@ def _update_tree(tree, new_tree):
     if tree is None:
         tree = new_tree
     else:
-        streams = next(tree.iter('streams'))
-        new_streams = next(new_tree.iter('streams'))
+        streams = get_streams_element(tree)
+        new_streams = get_streams_element(new_tree)
 
+        index = _name_index(streams)
         for new_stream in new_streams:
-            _update_element(new_stream, streams)
+            _update_element(new_stream, streams, index)
 
     return tree
 
 
-def _update_element(new_child, elements):
+def _name_index(elements):
     """
-    add the new child/grandchildren or add/update attributes if they exist
+    a dictionary of the named children of the given element, so they can be
+    found by name without searching
     """
-    if 'name' not in new_child.attrib:
-        return
+    return {child.attrib['name']: child for child in elements
+            if 'name' in child.attrib}
 
-    name = new_child.attrib['name']
-    found = False
-    for child in elements:
-        if child.attrib['name'] == name:
-            found = True
-            if child.tag != new_child.tag:
-                raise ValueError('Trying to update stream "{}" with '
-                                 'inconsistent tags {} vs. {}.'.format(
-                                     name, child.tag, new_child.tag))
 
-            # copy the attributes
-            for attr, value in new_child.attrib.items():
-                child.attrib[attr] = value
+def _update_defaults(new_child, defaults, index):
+    """
+    update or add a stream or its children starting from the defaults, where
+    ``index`` is the name index of ``defaults``
+    """
+    # work through the new elements in document order without recursion
+    stack = [(new_child, defaults, index)]
+    while stack:
+        new_child, defaults, index = stack.pop()
+        if 'name' not in new_child.attrib:
+            continue
+
+        name = new_child.attrib['name']
+        child = index.get(name)
+        if child is None:
+            # add a deep copy of the element (lxml's copy() copies the whole
+            # subtree)
+            child = copy(new_child)
+            defaults.append(child)
+            index[name] = child
+            continue
+
+        if child.tag != new_child.tag:
+            raise ValueError('Trying to update stream "{}" with '
+                             'inconsistent tags {} vs. {}.'.format(
+                                 name, child.tag, new_child.tag))
+
+        # copy the attributes
+        child.attrib.update(new_child.attrib)
+
+        if len(new_child) > 0:
+            # we don't want default grandchildren
+            for grandchild in child:
+                child.remove(grandchild)
 
             # copy or add the grandchildren's contents
-            for new_grandchild in new_child:
-                _update_element(new_grandchild, child)
+            grandchild_index = dict()
+            stack.extend((new_grandchild, child, grandchild_index)
+                         for new_grandchild in reversed(new_child))
+
 
-    if not found:
-        # add a deep copy of the element
-        elements.append(deepcopy(new_child))
+def _update_element(new_child, elements, index):
+    """
+    add the new child/grandchildren or add/update attributes if they exist,
+    where ``index`` is the name index of ``elements``
+    """
+    # work through the new elements in document order without recursion
+    stack = [(new_child, elements, index)]
+    while stack:
+        new_child, elements, index = stack.pop()
+        if 'name' not in new_child.attrib:
+            continue
+
+        name = new_child.attrib['name']
+        child = index.get(name)
+        if child is None:
+            # add a deep copy of the element (lxml's copy() copies the whole
+            # subtree)
+            child = copy(new_child)
+            elements.append(child)
+            index[name] = child
+            continue
+
+        if child.tag != new_child.tag:
+            raise ValueError('Trying to update stream "{}" with '
+                             'inconsistent tags {} vs. {}.'.format(
+                                 name, child.tag, new_child.tag))
+
+        # copy the attributes
+        child.attrib.update(new_child.attrib)
+
+        if len(new_child) > 0:
+            # copy or add the grandchildren's contents
+            grandchild_index = _name_index(child)
+            stack.extend((new_grandchild, child, grandchild_index)
+                         for new_grandchild in reversed(new_child))